@@ -1,14 +1,31 @@
+import os
 import pathlib
 import pandas as pd
 import shutil
+import multiprocessing
+import traceback
 
 import sys
 
+# idrstream is imported in each worker process (in run_stream), after the worker is pinned to its GPU
 sys.path.append("../IDR_stream/")
-from idrstream.DP_idr import DeepProfilerRun
 
 # directory with all locations data csvs (with plate/well/frame image location data for IDR_stream)
 locations_dir = pathlib.Path("../../0.locate_data/locations/")
+# column types of locations data, applied after pyarrow reads (and infers types for) the file,
+# so idrstream always gets the same types regardless of what pyarrow infers
+# the pyarrow engine requires pyarrow in the idrstream_dp environment (see ../README.md)
+locations_dtypes = {
+    "Plate": str,
+    "Well": str,
+    "Well Number": "int64",
+    "Original Gene Target": str,
+    "Frames": "int64",
+    "Plate_Map_Name": str,
+    "Gene_Replicate": "int64",
+    "Site": "int64",
+    "DNA": str,
+}
 
 # idr ID for MitoCheck data
 idr_id = "idr0013"
@@ -34,13 +51,68 @@ nuclei_model_specs = {
     "remove_edge_masks": True,
 }
 
-for data_locations_path in sorted(locations_dir.iterdir()):
+# necessary DP files to copy to each tmp dir
+config_path = pathlib.Path("../stream_files/DP_files/mitocheck_profiling_config.json")
+checkpoint_path = pathlib.Path(
+    "../stream_files/DP_files/efficientnet-b0_weights_tf_dim_ordering_tf_kernels_autoaugment.h5"
+)
+
+
+def get_gpu_ids() -> list:
+    """
+    get CUDA devices to spread data sets across
+    uses CUDA_VISIBLE_DEVICES if it is set, otherwise every device torch can see
+
+    Returns
+    -------
+    list
+        CUDA device ids, empty if no CUDA device is available
+    """
+    if "CUDA_VISIBLE_DEVICES" in os.environ:
+        return [
+            gpu_id
+            for gpu_id in os.environ["CUDA_VISIBLE_DEVICES"].split(",")
+            if gpu_id != ""
+        ]
+
+    # torch is installed with CellPose
+    import torch
+
+    return [str(gpu_id) for gpu_id in range(torch.cuda.device_count())]
+
+
+def pin_worker_gpu(gpu_id_queue: multiprocessing.Queue):
+    """
+    pin a worker process to one GPU before it imports idrstream (CellPose/DP)
+    each worker takes its own GPU from the queue, so no two workers share a GPU
+
+    Parameters
+    ----------
+    gpu_id_queue : multiprocessing.Queue
+        queue with one CUDA device id per worker
+    """
+    os.environ["CUDA_VISIBLE_DEVICES"] = gpu_id_queue.get()
+
+
+def run_stream(data_locations_path: pathlib.Path):
+    """
+    run IDR_stream DP for one data set
+    the process running this should already have CUDA_VISIBLE_DEVICES set to the GPU it may use (see pin_worker_gpu())
+
+    Parameters
+    ----------
+    data_locations_path : pathlib.Path
+        path to locations tsv with plate/well/frame image location data for IDR_stream
+    """
     # name of data being processed (training_data, negative_control_data, or positive_control_data)
     data_name = data_locations_path.name.replace("_locations.tsv", "_data")
-    print(f"Running IDR_stream DP for {data_name}")
+    print(
+        f"Running IDR_stream DP for {data_name} on GPU {os.environ.get('CUDA_VISIBLE_DEVICES')}"
+    )
 
     # path to temporary data directory that holds intermediate idrstream files
-    tmp_dir = pathlib.Path("tmp/")
+    # each data set gets its own tmp directory so parallel streams do not remove each other's files
+    tmp_dir = pathlib.Path(f"tmp/{data_name}")
     # remove tmp directory if it already exists (ex: from a previous IDR_stream run)
     shutil.rmtree(tmp_dir, ignore_errors=True)
     # path to final data directory (place final .csv.gz metadata+features are saved)
@@ -52,11 +124,22 @@ for data_locations_path in sorted(locations_dir.iterdir()):
     # create parent directory for log file if it doesn't exist
     log_file_path.parent.mkdir(exist_ok=True, parents=True)
 
+    # import idrstream only now that CUDA_VISIBLE_DEVICES is set for this process
+    from idrstream.DP_idr import DeepProfilerRun
+
     # initialize IDR_stream dp run
+    # each data set initializes its own stream (downloader, Fiji, CellPose, DP files) in its worker process,
+    # a stream holds a JVM and GPU models that cannot be shared between processes
     stream = DeepProfilerRun(idr_id, tmp_dir, final_data_dir, log=log_file_path)
 
     # pandas dataframe with plate/well/frame image location data for IDR_stream
-    data_to_process = pd.read_csv(data_locations_path, sep="\t", index_col=0)
+    data_to_process = pd.read_csv(
+        data_locations_path,
+        sep="\t",
+        index_col=0,
+        engine="pyarrow",
+        dtype=locations_dtypes,
+    )
 
     # initialize aspera downloader
     stream.init_downloader(aspera_path, aspera_key_path, screens_path)
@@ -68,12 +151,6 @@ for data_locations_path in sorted(locations_dir.iterdir()):
     stream.init_segmentor(nuclei_model_specs)
 
     # copy necessary DP files to tmp dir
-    config_path = pathlib.Path(
-        "../stream_files/DP_files/mitocheck_profiling_config.json"
-    )
-    checkpoint_path = pathlib.Path(
-        "../stream_files/DP_files/efficientnet-b0_weights_tf_dim_ordering_tf_kernels_autoaugment.h5"
-    )
     stream.copy_DP_files(config_path, checkpoint_path)
 
     # run dp IDR_stream!
@@ -90,3 +167,42 @@ for data_locations_path in sorted(locations_dir.iterdir()):
         stream.run_dp_stream(
             data_to_process, batch_size=3, start_batch=0, batch_nums=[0]
         )
+
+
+if __name__ == "__main__":
+    data_locations_paths = sorted(locations_dir.iterdir())
+    gpu_ids = get_gpu_ids()
+
+    # run data sets (training, negative control, positive control) in parallel, one worker process per GPU
+    # DeepProfiler (TensorFlow) reserves almost all memory of its GPU, so workers never share a GPU,
+    # data sets beyond the number of GPUs wait for a worker to finish (a single worker runs all of them without a GPU)
+    num_workers = max(1, len(gpu_ids))
+    # spawn (not fork) so each worker starts its own JVM and CUDA context
+    spawn_context = multiprocessing.get_context("spawn")
+    gpu_id_queue = spawn_context.Queue()
+    for gpu_id in gpu_ids:
+        gpu_id_queue.put(gpu_id)
+
+    with spawn_context.Pool(
+        num_workers,
+        initializer=pin_worker_gpu if len(gpu_ids) > 0 else None,
+        initargs=(gpu_id_queue,) if len(gpu_ids) > 0 else (),
+    ) as pool:
+        stream_results = {
+            data_locations_path.name: pool.apply_async(
+                run_stream, (data_locations_path,)
+            )
+            for data_locations_path in data_locations_paths
+        }
+
+        # wait for all streams and raise if any of them failed
+        failed_data = []
+        for data_name, stream_result in stream_results.items():
+            try:
+                stream_result.get()
+            except Exception:
+                traceback.print_exc()
+                failed_data.append(data_name)
+
+    if len(failed_data) > 0:
+        raise RuntimeError(f"IDR_stream DP failed for {failed_data}")
@@ -9,11 +9,12 @@
 import pathlib
 import pandas as pd
 import numpy as np
+import matplotlib.pyplot as plt
 
 import sys
 sys.path.append("../utils")
-from load_utils import compile_mitocheck_batch_data, split_data
-from analysis_utils import get_2D_umap_embeddings, show_2D_umap_from_embeddings
+from load_utils import load_compiled_mitocheck_batch_data, split_data
+from analysis_utils import get_2D_umap_embeddings, show_2D_umap_from_embeddings, get_class_colors
 
 
 # ### Compile control data
@@ -21,20 +22,39 @@ from analysis_utils import get_2D_umap_embeddings, show_2D_umap_from_embeddings
 # In[2]:
 
 
+# directory to cache compiled control features, so re-running the notebook does not re-parse every batch
+compiled_data_cache_dir = pathlib.Path("compiled_data_cache")
+
 # get 10% of negative control features
 negative_control_data_path = pathlib.Path("../1.idr_streams/extracted_features/negative_control_data/merged_features")
-negative_control_data = compile_mitocheck_batch_data(negative_control_data_path)
-negative_control_data = negative_control_data.sample(frac=0.1, random_state=0)
+negative_control_data = load_compiled_mitocheck_batch_data(
+    negative_control_data_path,
+    compiled_data_cache_dir / "negative_control_data_10_percent.parquet",
+    sample_frac=0.1,
+)
 
 # get 10% of positive control features
 positive_control_data_path = pathlib.Path("../1.idr_streams/extracted_features/positive_control_data/merged_features")
-positive_control_data = compile_mitocheck_batch_data(positive_control_data_path)
-positive_control_data = positive_control_data.sample(frac=0.1, random_state=0)
+positive_control_data = load_compiled_mitocheck_batch_data(
+    positive_control_data_path,
+    compiled_data_cache_dir / "positive_control_data_10_percent.parquet",
+    sample_frac=0.1,
+)
 
 # combine negative and positive control features
 control_data = pd.concat([negative_control_data, positive_control_data])
 # shuffle data so negative/positive controls are not ordered
 control_data = control_data.sample(frac=1, random_state=0)
+
+# directory to cache UMAP embeddings, so re-running the notebook does not refit UMAP
+umap_cache_dir = pathlib.Path("umap_cache")
+
+# metadata fields to color umaps by, with colors for each field's classes (shared by all feature sets)
+metadata_fields = ["Metadata_Plate", "Metadata_Well", "Metadata_Frame", "Metadata_Gene"]
+metadata_class_colors = {
+    metadata_field: get_class_colors(control_data[metadata_field].unique().tolist(), "bright")
+    for metadata_field in metadata_fields
+}
 control_data
 
 
@@ -44,13 +64,16 @@ control_data
 
 
 metadata_dataframe, feature_data = split_data(control_data, "CP")
-x_data, y_data = get_2D_umap_embeddings(feature_data)
-
-metadata_fields = ["Metadata_Plate", "Metadata_Well", "Metadata_Frame", "Metadata_Gene"]
+x_data, y_data = get_2D_umap_embeddings(feature_data, cache_dir=umap_cache_dir)
 
-for metadata_field in metadata_fields:
+# draw the umaps for each metadata field on one figure
+# one row per metadata field, so each legend has room to the right of its umap
+fig, axes = plt.subplots(len(metadata_fields), 1, figsize=(15, 12 * len(metadata_fields)))
+for ax, metadata_field in zip(axes.flat, metadata_fields):
     metadata = metadata_dataframe[metadata_field]
-    show_2D_umap_from_embeddings(x_data, y_data, metadata)
+    show_2D_umap_from_embeddings(
+        x_data, y_data, metadata, ax=ax, class_colors=metadata_class_colors[metadata_field]
+    )
 
 
 # ### Create 2D umaps colored by metadata (with DP features)
@@ -59,13 +82,16 @@ for metadata_field in metadata_fields:
 
 
 metadata_dataframe, feature_data = split_data(control_data, "DP")
-x_data, y_data = get_2D_umap_embeddings(feature_data)
-
-metadata_fields = ["Metadata_Plate", "Metadata_Well", "Metadata_Frame", "Metadata_Gene"]
+x_data, y_data = get_2D_umap_embeddings(feature_data, cache_dir=umap_cache_dir)
 
-for metadata_field in metadata_fields:
+# draw the umaps for each metadata field on one figure
+# one row per metadata field, so each legend has room to the right of its umap
+fig, axes = plt.subplots(len(metadata_fields), 1, figsize=(15, 12 * len(metadata_fields)))
+for ax, metadata_field in zip(axes.flat, metadata_fields):
     metadata = metadata_dataframe[metadata_field]
-    show_2D_umap_from_embeddings(x_data, y_data, metadata)
+    show_2D_umap_from_embeddings(
+        x_data, y_data, metadata, ax=ax, class_colors=metadata_class_colors[metadata_field]
+    )
 
 
 # ### Create 2D umaps colored by metadata (with CP and DP features)
@@ -74,11 +100,14 @@ for metadata_field in metadata_fields:
 
 
 metadata_dataframe, feature_data = split_data(control_data)
-x_data, y_data = get_2D_umap_embeddings(feature_data)
-
-metadata_fields = ["Metadata_Plate", "Metadata_Well", "Metadata_Frame", "Metadata_Gene"]
+x_data, y_data = get_2D_umap_embeddings(feature_data, cache_dir=umap_cache_dir)
 
-for metadata_field in metadata_fields:
+# draw the umaps for each metadata field on one figure
+# one row per metadata field, so each legend has room to the right of its umap
+fig, axes = plt.subplots(len(metadata_fields), 1, figsize=(15, 12 * len(metadata_fields)))
+for ax, metadata_field in zip(axes.flat, metadata_fields):
     metadata = metadata_dataframe[metadata_field]
-    show_2D_umap_from_embeddings(x_data, y_data, metadata)
+    show_2D_umap_from_embeddings(
+        x_data, y_data, metadata, ax=ax, class_colors=metadata_class_colors[metadata_field]
+    )
 
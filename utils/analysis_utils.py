@@ -1,3 +1,7 @@
+import hashlib
+import math
+import pathlib
+
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.lines import Line2D
@@ -5,12 +9,123 @@ from matplotlib.colors import rgb2hex
 import seaborn as sns
 import pandas as pd
 import umap
+import pynndescent
+from sklearn.decomposition import PCA
+from sklearn.pipeline import make_pipeline
+
+# RAPIDS cuML is optional, UMAP falls back to umap-learn (CPU) without it
+try:
+    import cupy
+    from cuml.manifold import UMAP as cuUMAP
+except ImportError:
+    cupy = None
+    cuUMAP = None
 
 # make random np operations reproducible
 np.random.seed(0)
 
 
-def get_2D_umap_embeddings(feature_data: np.ndarray, random_state: int = 0):
+def cuda_available() -> bool:
+    """
+    check if cuML and a CUDA device are available for GPU UMAP
+
+    Returns
+    -------
+    bool
+        True if cuML is installed and at least one CUDA device is visible
+    """
+    if cuUMAP is None:
+        return False
+    try:
+        return cupy.cuda.runtime.getDeviceCount() > 0
+    except cupy.cuda.runtime.CUDARuntimeError:
+        return False
+
+
+def get_pca_features(feature_data: np.ndarray, n_components: int = 50) -> tuple:
+    """
+    reduce feature data to its first principal components before umap/kNN
+    feature data with n_components or fewer features is returned unchanged
+    PCA is always seeded, so the same features get the same projection even if umap is unseeded
+
+    Parameters
+    ----------
+    feature_data : np.ndarray
+        feature data to reduce
+    n_components : int, optional
+        number of principal components to keep, by default 50
+
+    Returns
+    -------
+    np.ndarray, PCA
+        principal component values, fitted PCA (None if feature data was returned unchanged)
+    """
+    if feature_data.shape[1] <= n_components:
+        return feature_data, None
+
+    pca = PCA(n_components=n_components, random_state=0)
+    return pca.fit_transform(feature_data), pca
+
+
+def get_knn_graph(
+    feature_data: np.ndarray,
+    n_neighbors: int = 15,
+    random_state: int = None,
+    n_jobs: int = -1,
+    pca_preprocess: bool = True,
+) -> tuple:
+    """
+    build k-nearest-neighbor graph with NN-descent for reuse across umap runs
+
+    Parameters
+    ----------
+    feature_data : np.ndarray
+        feature data to find nearest neighbors for
+    n_neighbors : int, optional
+        number of nearest neighbors, must match umap n_neighbors, by default 15
+    random_state : int, optional
+        random state for NN-descent, by default None (parallel, non-deterministic)
+    n_jobs : int, optional
+        number of threads NN-descent can use, by default -1 (all cores)
+    pca_preprocess : bool, optional
+        whether to reduce feature data to 50 principal components first, by default True
+        must match pca_preprocess of the get_2D_umap_embeddings() call the graph is used for
+
+    Returns
+    -------
+    tuple
+        knn indices, knn distances, NN-descent search index (umap precomputed_knn format)
+    """
+    # cast features to float32 so the graph matches get_2D_umap_embeddings() inputs
+    feature_data = np.ascontiguousarray(np.asarray(feature_data), dtype=np.float32)
+
+    if pca_preprocess:
+        feature_data, _ = get_pca_features(feature_data)
+
+    knn_search_index = pynndescent.NNDescent(
+        feature_data,
+        n_neighbors=n_neighbors,
+        random_state=random_state,
+        n_jobs=n_jobs,
+        low_memory=False,
+    )
+    knn_indices, knn_dists = knn_search_index.neighbor_graph
+
+    return knn_indices, knn_dists, knn_search_index
+
+
+def get_2D_umap_embeddings(
+    feature_data: np.ndarray,
+    random_state: int = None,
+    n_jobs: int = -1,
+    backend: str = "cuml",
+    precomputed_knn: tuple = None,
+    pca_preprocess: bool = True,
+    cache_dir: pathlib.Path = None,
+    knn_graphs: dict = None,
+    reducer=None,
+    return_reducer: bool = False,
+):
     """
     get 2D umap embeddings for numpy array as x and y vectors
 
@@ -19,23 +134,142 @@ def get_2D_umap_embeddings(feature_data: np.ndarray, random_state: int = 0):
     feature_data : np.ndarray
         feature data to find embeddings for
     random_state : int, optional
-        random state for umap embeddings, by default 0
+        random state for umap embeddings, by default None
+        a random state makes embeddings reproducible but forces umap-learn to run single-threaded,
+        without one NN-descent and the layout optimization run in parallel (embeddings differ slightly between runs)
+    n_jobs : int, optional
+        number of threads umap-learn can use when random_state is None, by default -1 (all cores)
+    backend : str, optional
+        UMAP implementation to use, can be "umap" (umap-learn, CPU), "parametric" (umap-learn ParametricUMAP, requires tensorflow),
+        or by default "cuml" (RAPIDS, GPU, batch-parallel layout optimization)
+        "cuml" falls back to "umap" if cuML or a CUDA device is unavailable
+    precomputed_knn : tuple, optional
+        kNN graph from get_knn_graph() for feature_data (with the same pca_preprocess), by default None (kNN graph is built by umap)
+        only used by the "umap" and "parametric" backends, cuML builds its kNN graph on the GPU
+    pca_preprocess : bool, optional
+        whether to reduce feature data to 50 principal components before umap, by default True
+    cache_dir : pathlib.Path, optional
+        directory to save/load embeddings keyed on a hash of feature_data and umap settings,
+        by default None (umap is always fit)
+    knn_graphs : dict, optional
+        in-memory cache of kNN graphs keyed on a hash of feature_data, by default None (no kNN graphs are cached)
+        only looked up (or built with get_knn_graph() and added) when umap is fit, after cache_dir misses,
+        and only for the "umap" and "parametric" backends
+    reducer : optional
+        fitted reducer returned by a previous call with return_reducer=True (any backend, ex: a "parametric" encoder),
+        used to embed feature_data with its transform instead of fitting umap, by default None
+        feature_data must have the same feature columns the reducer was fit on (backend and pca_preprocess are ignored)
+    return_reducer : bool, optional
+        whether to also return the fitted reducer, by default False
+        if PCA preprocessing was applied, the reducer is a pipeline of the fitted PCA and umap so it transforms unreduced feature data
 
     Returns
     -------
     np.ndarray, np.ndarray
-        X data vector, y data vector
+        X data vector, y data vector (and fitted reducer if return_reducer)
     """
-    # create umap object for dimension reduction
-    reducer = umap.UMAP(random_state=random_state, n_components=2)
+    if backend not in ["umap", "cuml", "parametric"]:
+        raise ValueError(
+            f"backend must be 'umap', 'cuml', or 'parametric', not '{backend}'"
+        )
+    # cuML umap needs a CUDA device, use umap-learn without one
+    if backend == "cuml" and not cuda_available():
+        backend = "umap"
+
+    # cast features to one contiguous float32 buffer, halving memory traffic in umap distance kernels
+    feature_data = np.ascontiguousarray(np.asarray(feature_data), dtype=np.float32)
+
+    # umap is only fit (and embeddings only cached) if no fitted reducer is given
+    fit_reducer = reducer is None
+
+    # hash features to identify cached embeddings and kNN graphs
+    if fit_reducer and (cache_dir is not None or knn_graphs is not None):
+        feature_hash = hashlib.blake2b(feature_data, digest_size=16)
+        feature_hash.update(str(feature_data.shape).encode())
+        feature_hash = feature_hash.hexdigest()
+
+    # load embeddings if umap has already been fit on these features with these settings
+    if cache_dir is not None and fit_reducer:
+        cache_key = f"{feature_hash}_{random_state}_{backend}_{pca_preprocess}"
+        cache_path = pathlib.Path(f"{cache_dir}/{cache_key}.npz")
+        if cache_path.exists() and not return_reducer:
+            cached_embeddings = np.load(cache_path)
+            return cached_embeddings["x_data"], cached_embeddings["y_data"]
+
+    if not fit_reducer:
+        # embed features with the given reducer (ex: forward pass of a parametric umap encoder)
+        embedding = reducer.transform(feature_data)
+        # cuML returns embeddings on the GPU for GPU inputs
+        if cupy is not None and isinstance(embedding, cupy.ndarray):
+            embedding = embedding.get()
+    else:
+        # reduce dimensionality of features once to speed up umap kNN distance computations,
+        # the kNN graph and umap are both computed from the reduced features
+        pca = None
+        if pca_preprocess:
+            feature_data, pca = get_pca_features(feature_data)
+
+        if backend == "cuml":
+            # create GPU umap object for dimension reduction
+            reducer = cuUMAP(
+                n_components=2,
+                random_state=random_state,
+                build_algo="nn_descent",
+                init="random",
+            )
+            # move features to GPU, fit UMAP, and move embeddings back to host
+            gpu_feature_data = cupy.asarray(feature_data)
+            embedding = reducer.fit_transform(gpu_feature_data).get()
+        else:
+            # reuse the kNN graph for these features or build it, only now that the embeddings were not cached
+            if precomputed_knn is None and knn_graphs is not None:
+                knn_key = f"{feature_hash}_{pca_preprocess}"
+                if knn_key not in knn_graphs:
+                    knn_graphs[knn_key] = get_knn_graph(
+                        feature_data,
+                        random_state=random_state,
+                        n_jobs=n_jobs,
+                        pca_preprocess=False,
+                    )
+                precomputed_knn = knn_graphs[knn_key]
+
+            # NN-descent (pynndescent) builds the kNN graph, parallelized across cores if umap is not seeded
+            umap_params = dict(
+                random_state=random_state,
+                n_components=2,
+                n_neighbors=15,
+                n_jobs=n_jobs,
+                low_memory=False,
+                precomputed_knn=(None, None, None)
+                if precomputed_knn is None
+                else precomputed_knn,
+            )
+            # create umap object for dimension reduction
+            if backend == "parametric":
+                # parametric umap depends on tensorflow, only import it when it is used
+                from umap.parametric_umap import ParametricUMAP
 
-    # Fit UMAP and extract latent vars 1-2
-    embedding = reducer.fit_transform(feature_data)
-    embedding = np.transpose(embedding)
+                reducer = ParametricUMAP(n_training_epochs=1, **umap_params)
+            else:
+                reducer = umap.UMAP(**umap_params)
+            # Fit UMAP
+            embedding = reducer.fit_transform(feature_data)
 
-    # convert to seaborn-recognizable vectors
-    x_data = embedding[0]
-    y_data = embedding[1]
+        # keep the fitted PCA with the reducer so new feature data is transformed the same way
+        if pca is not None:
+            reducer = make_pipeline(pca, reducer)
+
+    # extract latent vars 1-2 as contiguous x and y vectors
+    x_data = np.ascontiguousarray(embedding[:, 0])
+    y_data = np.ascontiguousarray(embedding[:, 1])
+
+    # save embeddings for later runs on the same features
+    if cache_dir is not None and fit_reducer:
+        cache_path.parent.mkdir(exist_ok=True, parents=True)
+        np.savez(cache_path, x_data=x_data, y_data=y_data)
+
+    if return_reducer:
+        return x_data, y_data, reducer
 
     return x_data, y_data
 
@@ -48,6 +282,8 @@ def show_2D_umap_from_embeddings(
     point_size: int = 5,
     alpha: float = 1,
     palette: str = "bright",
+    ax: plt.Axes = None,
+    class_colors: dict = None,
 ):
     """
     show 2D umap from 2D UMAP embeddings, save if desired
@@ -68,32 +304,50 @@ def show_2D_umap_from_embeddings(
         opacity of umap points, by default 1
     palette : str, optional
         color palette used to color points, by default "bright"
+    ax : plt.Axes, optional
+        axes to draw umap on (ex: one subplot of a grid), by default None (a new figure is created)
+        the legend is drawn to the right of the axes, so leave room there (ex: a grid with one column)
+    class_colors : dict, optional
+        colors for metadata classes (ex: from get_class_colors()),
+        by default None (colors are derived from palette for the classes in metadata_series)
     """
 
-    plt.figure(figsize=(15, 12))
+    if ax is None:
+        plt.figure(figsize=(15, 12))
+        ax = plt.gca()
+
+    # map each metadata class to a palette color once and color points by lookup
+    if class_colors is None:
+        class_colors = get_class_colors(metadata_series.unique().tolist(), palette)
+    colors, legend_elements = get_class_point_colors(metadata_series, class_colors)
 
     # Produce scatterplot with umap data, using metadata to color points
-    sns_plot = sns.scatterplot(
-        palette=palette,
-        x=x_data,
-        y=y_data,
-        hue=metadata_series.tolist(),
-        alpha=alpha,
-        linewidth=0,
+    # points are rasterized so saved vector images do not hold one path per point
+    ax.scatter(
+        x_data,
+        y_data,
+        c=colors,
         s=point_size,
+        alpha=alpha,
+        linewidths=0,
+        rasterized=True,
     )
-    # Adjust legend
-    sns_plot.legend(
-        loc="center left", bbox_to_anchor=(1, 0.5), title=metadata_series.name
+    # Adjust legend, using more columns for many classes so the legend is no taller than the axes
+    ax.legend(
+        handles=legend_elements,
+        loc="center left",
+        bbox_to_anchor=(1, 0.5),
+        title=metadata_series.name,
+        ncol=math.ceil(len(legend_elements) / 40),
     )
     # Label axes, title
-    sns_plot.set_xlabel("UMAP 1")
-    sns_plot.set_ylabel("UMAP 2")
-    sns_plot.set_title("2 Dimensional UMAP")
+    ax.set_xlabel("UMAP 1")
+    ax.set_ylabel("UMAP 2")
+    ax.set_title("2 Dimensional UMAP")
 
     # save umap
     if not save_path == None:
-        plt.savefig(save_path, bbox_inches="tight")
+        ax.figure.savefig(save_path, bbox_inches="tight")
 
 
 def get_class_colors(classes_list: list, palette: str) -> dict:
@@ -122,6 +376,73 @@ def get_class_colors(classes_list: list, palette: str) -> dict:
     return class_colors
 
 
+def get_class_point_colors(metadata_series: pd.Series, class_colors: dict):
+    """
+    get per-point colors and legend elements for metadata classes
+    classes not included in class_colors will be colored gray and grouped as "Other"
+
+    Parameters
+    ----------
+    metadata_series : pd.Series
+        metadata used to color data
+    class_colors : dict
+        colors for classes, any classes not specified will be gray
+
+    Returns
+    -------
+    np.ndarray, list
+        hex color string for each point, legend elements for classes present in metadata
+    """
+    other_color = "#808080"
+
+    # group points by class in one pass, codes index each point's class in metadata_classes
+    codes, metadata_classes = pd.factorize(metadata_series)
+
+    # find which classes have colors once, for both coloring and the "other" legend entry
+    known_classes = metadata_classes.isin(list(class_colors.keys()))
+
+    # color each class (not each point) by its class color or gray if it should not be colored
+    metadata_class_colors = np.append(
+        np.where(known_classes, metadata_classes.map(class_colors), other_color),
+        other_color,
+    ).astype(object)
+    # missing metadata values have code -1, which indexes the trailing gray entry
+    colors = metadata_class_colors[codes]
+
+    # add each colored class present in the metadata to legend
+    present_classes = set(metadata_classes[known_classes])
+    legend_elements = [
+        Line2D(
+            [0],
+            [0],
+            marker="o",
+            color="w",
+            label=metadata_class,
+            markerfacecolor=color,
+            markersize=10,
+        )
+        for metadata_class, color in class_colors.items()
+        if metadata_class in present_classes
+    ]
+
+    # add "other" to legend if there are "other" classes
+    other_classes_exist = bool((codes == -1).any() or (~known_classes).any())
+    if other_classes_exist:
+        legend_elements.append(
+            Line2D(
+                [0],
+                [0],
+                marker="o",
+                color="w",
+                label="Other",
+                markerfacecolor=other_color,
+                markersize=10,
+            )
+        )
+
+    return colors, legend_elements
+
+
 def show_1D_umap(
     feature_data: np.ndarray,
     metadata_series: pd.Series,
@@ -154,62 +475,28 @@ def show_1D_umap(
     # Fit UMAP and extract latent vars
     embedding = pd.DataFrame(reducer.fit_transform(feature_data), columns=["UMAP1"])
     # add phenotypic class to embeddings
-    embedding[metadata_series.name] = metadata_series.tolist()
+    embedding[metadata_series.name] = metadata_series.to_numpy()
 
     # create random y distribution to space out points
     y_distribution = np.random.rand(feature_data.shape[0])
-    embedding["y_distribution"] = y_distribution.tolist()
+    embedding["y_distribution"] = y_distribution
 
     fig = plt.figure(figsize=(15, 15))
     ax = fig.gca()
-    legend_elements = []
-
-    # keep track of if "other" classes exist
-    other_classes_exist = False
-
-    # add each phenotypic class to 1d graph and legend
-    for index, metadata_class in enumerate(
-        embedding[metadata_series.name].unique().tolist()
-    ):
-        class_embedding = embedding.loc[
-            embedding[metadata_series.name] == metadata_class
-        ]
-        x = class_embedding["UMAP1"]
-        y = class_embedding["y_distribution"]
-
-        # color by class or gray if it should not be colored
-        if metadata_class in class_colors.keys():
-            color = class_colors[metadata_class]
-            legend_elements.append(
-                Line2D(
-                    [0],
-                    [0],
-                    marker="o",
-                    color="w",
-                    label=metadata_class,
-                    markerfacecolor=color,
-                    markersize=10,
-                )
-            )
-        else:
-            other_classes_exist = True
-            color = "#808080"
 
-        ax.scatter(x, y, c=color, marker="o", alpha=alpha, s=point_size)
+    # color points by class, classes not in class_colors are gray
+    colors, legend_elements = get_class_point_colors(metadata_series, class_colors)
 
-    # add "other" to legend if there are "other" classes
-    if other_classes_exist:
-        legend_elements.append(
-            Line2D(
-                [0],
-                [0],
-                marker="o",
-                color="w",
-                label="Other",
-                markerfacecolor=color,
-                markersize=10,
-            )
-        )
+    # add all points to graph in one (rasterized) scatter collection
+    ax.scatter(
+        embedding["UMAP1"].to_numpy(),
+        embedding["y_distribution"].to_numpy(),
+        c=colors,
+        marker="o",
+        alpha=alpha,
+        s=point_size,
+        rasterized=True,
+    )
 
     plt.legend(handles=legend_elements, loc="center left", bbox_to_anchor=(1, 0.5))
     # Label axes, title
@@ -258,58 +545,24 @@ def show_2D_umap(
         reducer.fit_transform(feature_data), columns=["UMAP1", "UMAP2"]
     )
     # add phenotypic class to embeddings
-    embedding[metadata_series.name] = metadata_series.tolist()
+    embedding[metadata_series.name] = metadata_series.to_numpy()
 
     fig = plt.figure(figsize=(15, 15))
     ax = fig.gca()
-    legend_elements = []
-
-    # keep track of if "other" classes exist
-    other_classes_exist = False
-
-    # add each phenotypic class to 1d graph and legend
-    for index, metadata_class in enumerate(
-        embedding[metadata_series.name].unique().tolist()
-    ):
-        class_embedding = embedding.loc[
-            embedding[metadata_series.name] == metadata_class
-        ]
-        x = class_embedding["UMAP1"]
-        y = class_embedding["UMAP2"]
-
-        # color by class or gray if it should not be colored
-        if metadata_class in class_colors.keys():
-            color = class_colors[metadata_class]
-            legend_elements.append(
-                Line2D(
-                    [0],
-                    [0],
-                    marker="o",
-                    color="w",
-                    label=metadata_class,
-                    markerfacecolor=color,
-                    markersize=10,
-                )
-            )
-        else:
-            other_classes_exist = True
-            color = "#808080"
 
-        ax.scatter(x, y, c=color, marker="o", alpha=alpha, s=point_size)
+    # color points by class, classes not in class_colors are gray
+    colors, legend_elements = get_class_point_colors(metadata_series, class_colors)
 
-    # add "other" to legend if there are "other" classes
-    if other_classes_exist:
-        legend_elements.append(
-            Line2D(
-                [0],
-                [0],
-                marker="o",
-                color="w",
-                label="Other",
-                markerfacecolor=color,
-                markersize=10,
-            )
-        )
+    # add all points to graph in one (rasterized) scatter collection
+    ax.scatter(
+        embedding["UMAP1"].to_numpy(),
+        embedding["UMAP2"].to_numpy(),
+        c=colors,
+        marker="o",
+        alpha=alpha,
+        s=point_size,
+        rasterized=True,
+    )
 
     plt.legend(handles=legend_elements, loc="center left", bbox_to_anchor=(1, 0.5))
     # Label axes, title
@@ -360,59 +613,25 @@ def show_3D_umap(
         reducer.fit_transform(feature_data), columns=["UMAP1", "UMAP2", "UMAP3"]
     )
     # add phenotypic class to embeddings
-    embedding[metadata_series.name] = metadata_series.tolist()
+    embedding[metadata_series.name] = metadata_series.to_numpy()
 
     fig = plt.figure(figsize=(15, 15))
     ax = fig.gca(projection="3d")
-    legend_elements = []
-
-    # keep track of if "other" classes exist
-    other_classes_exist = False
-
-    # add each phenotypic class to 3d graph and legend
-    for index, metadata_class in enumerate(
-        embedding[metadata_series.name].unique().tolist()
-    ):
-        class_embedding = embedding.loc[
-            embedding[metadata_series.name] == metadata_class
-        ]
-        x = class_embedding["UMAP1"]
-        y = class_embedding["UMAP2"]
-        z = class_embedding["UMAP3"]
-
-        # color by class or gray if it should not be colored
-        if metadata_class in class_colors.keys():
-            color = class_colors[metadata_class]
-            legend_elements.append(
-                Line2D(
-                    [0],
-                    [0],
-                    marker="o",
-                    color="w",
-                    label=metadata_class,
-                    markerfacecolor=color,
-                    markersize=10,
-                )
-            )
-        else:
-            other_classes_exist = True
-            color = "#808080"
 
-        ax.scatter(x, y, z, c=color, marker="o", alpha=alpha, s=point_size)
+    # color points by class, classes not in class_colors are gray
+    colors, legend_elements = get_class_point_colors(metadata_series, class_colors)
 
-    # add "other" to legend if there are "other" classes
-    if other_classes_exist:
-        legend_elements.append(
-            Line2D(
-                [0],
-                [0],
-                marker="o",
-                color="w",
-                label="Other",
-                markerfacecolor=color,
-                markersize=10,
-            )
-        )
+    # add all points to graph in one (rasterized) scatter collection
+    ax.scatter(
+        embedding["UMAP1"].to_numpy(),
+        embedding["UMAP2"].to_numpy(),
+        embedding["UMAP3"].to_numpy(),
+        c=colors,
+        marker="o",
+        alpha=alpha,
+        s=point_size,
+        rasterized=True,
+    )
 
     plt.legend(handles=legend_elements, loc="center left", bbox_to_anchor=(1, 0.5))
     # Label axes, title
@@ -1,9 +1,13 @@
 import pathlib
+import numpy as np
 import pandas as pd
 
 
 def compile_mitocheck_batch_data(
-    data_path: pathlib.Path, dataset: str = "CP_and_DP"
+    data_path: pathlib.Path,
+    dataset: str = "CP_and_DP",
+    sample_frac: float = None,
+    random_state: int = 0,
 ) -> pd.DataFrame:
     """
     compile batch data from a mitocheck idrstream merged features run
@@ -16,6 +20,14 @@ def compile_mitocheck_batch_data(
     dataset : str, optional
         which dataset columns to load in (in addition to metadata),
         can be "CP" or "DP" or by default "CP_and_DP"
+    sample_frac : float, optional
+        fraction of rows to randomly keep from each batch while it is read (rows that are not kept are never parsed),
+        each row is kept with probability sample_frac so the number of rows kept is approximate,
+        by default None (all rows are kept)
+    random_state : int, optional
+        random state for row sampling, by default 0
+        one random generator is shared across batches, so which rows are kept also depends on
+        the order data_path.iterdir() returns the batches in
 
     Returns
     -------
@@ -25,6 +37,14 @@ def compile_mitocheck_batch_data(
 
     data = pd.DataFrame()
 
+    # skip each row (besides the header row) with probability 1 - sample_frac
+    skiprows = None
+    if sample_frac is not None:
+        rng = np.random.default_rng(random_state)
+
+        def skiprows(row_index: int) -> bool:
+            return row_index > 0 and rng.random() > sample_frac
+
     # determine which cols to use for loading (depending on dataset)
     # load in first row to get all column names
     batch_0_row_0 = pd.read_csv(
@@ -65,7 +85,11 @@ def compile_mitocheck_batch_data(
             compression="gzip",
             low_memory=True,
             usecols=cols_to_load,
+            skiprows=skiprows,
         )
+        # sampling can skip every row of a small batch
+        if batch.empty:
+            continue
 
         # split well_frame into well and frame columns
         batch[["Metadata_Well", "Metadata_Frame"]] = batch["Metadata_Well"].str.split(
@@ -81,6 +105,50 @@ def compile_mitocheck_batch_data(
     return data.reset_index(drop=True)
 
 
+def load_compiled_mitocheck_batch_data(
+    data_path: pathlib.Path,
+    cache_path: pathlib.Path,
+    dataset: str = "CP_and_DP",
+    sample_frac: float = None,
+    random_state: int = 0,
+) -> pd.DataFrame:
+    """
+    load compiled batch data from a parquet cache, compiling and caching it with compile_mitocheck_batch_data() if the cache does not exist
+    delete the cache file to recompile after the batch data changes
+
+    Parameters
+    ----------
+    data_path : pathlib.Path
+        path to folder with saved batches
+        these batches must be merged (have CP and DP features)
+    cache_path : pathlib.Path
+        path to parquet file with compiled batch data,
+        must be outside data_path (every file in data_path is read as a batch)
+    dataset : str, optional
+        which dataset columns to load in (in addition to metadata),
+        can be "CP" or "DP" or by default "CP_and_DP"
+    sample_frac : float, optional
+        fraction of rows to randomly keep from each batch, by default None (all rows are kept)
+        the cache holds the sampled data, so use a different cache_path for each sample_frac
+    random_state : int, optional
+        random state for row sampling, by default 0
+
+    Returns
+    -------
+    pd.DataFrame
+        compiled batch dataframe
+    """
+    if cache_path.exists():
+        return pd.read_parquet(cache_path, engine="pyarrow", memory_map=True)
+
+    data = compile_mitocheck_batch_data(data_path, dataset, sample_frac, random_state)
+
+    cache_path.parent.mkdir(exist_ok=True, parents=True)
+    data.to_parquet(cache_path, engine="pyarrow", compression="zstd")
+
+    return data
+
+
 def split_data(pycytominer_output: pd.DataFrame, dataset: str = "CP_and_DP"):
     """
     split pycytominer output to metadata dataframe and np array of feature values